@@ -1,16 +1,21 @@
-from collections import defaultdict
+from dataclasses import dataclass, field
 from portainer_api import PortainerAPI
 from urllib.parse import urlparse
-import concurrent.futures
+import asyncio
+import logging
 import os
 import pandas as pd
+import xlsxwriter
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+log = logging.getLogger("extract")
 
 url_portainer = os.environ.get('PORTAINER_HOST')
 username = os.environ.get('PORTAINER_USER')
 password = os.environ.get('PORTAINER_PASSWORD')
 
-# Concurrency
-num_workers = 32
+# Concurrency (maximum simultaneous HTTP connections to Portainer)
+max_connections = 128
 
 # Check if all the necessary environment variables are defined
 if not url_portainer or not username or not password:
@@ -20,102 +25,191 @@ if not url_portainer or not username or not password:
 parsed_url = urlparse(url_portainer)
 domain_slug = parsed_url.netloc.split('.')[0]  # Extract the first part of the domain
 
-# Create an instance of PortainerAPI
-portainer_api = PortainerAPI(url_portainer, username, password)
+# Columns of each sheet
+ENDPOINT_COLUMNS = ("Endpoint_Id", "Endpoint_Name", "Group_Id", "Group_Name")
+SERVICE_COLUMNS = ("Endpoint_Id", "Endpoint", "Group", "Stack", "Name", "Replicas", "Image",
+                   "Environment_Variables", "Configurations", "Mounts")
+SECRET_COLUMNS = ("Endpoint", "Type", "Names")
+NODE_COLUMNS = ("Endpoint", "Hostname", "Role", "Availability", "NanoCPUs", "MemoryBytes", "State")
+CONTAINER_STATS_COLUMNS = ("Endpoint", "Stack", "Service", "Name", "CPU_Percent", "Memory_Usage", "Memory_Limit",
+                           "Memory_Percent")
+
+
+@dataclass
+class Table:
+    """ Column-oriented accumulator for the rows of a sheet """
+    columns: tuple
+    data: dict = field(init=False)
+
+    def __post_init__(self):
+        self.data = {column: [] for column in self.columns}
+
+    def append(self, *values):
+        """ Append a row, with values given in column order """
+        for column_values, value in zip(self.data.values(), values):
+            column_values.append(value)
+
+    def extend(self, other):
+        """ Append all the rows of another table with the same columns """
+        for column, column_values in self.data.items():
+            column_values.extend(other.data[column])
+
+    def rows(self):
+        """ Iterate over the rows as tuples """
+        return zip(*self.data.values())
 
-# Get all the endpoints available in Portainer
-endpoints = portainer_api.get_endpoints()
+    def to_dataframe(self):
+        """ Build a DataFrame directly from the columns """
+        return pd.DataFrame(self.data, columns=list(self.columns))
+
+
+def excel_value(value):
+    """ Convert a DataFrame value into one accepted by the Excel writer """
+    if isinstance(value, (list, tuple, dict)):
+        return str(value)
+    if pd.isna(value):
+        return None
+    return value
+
+
+def write_sheet(workbook, sheet_name, df, header_format=None):
+    """ Write a DataFrame into a new worksheet, one row at a time """
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, list(df.columns), header_format)
+    for row_number, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_number, 0, [excel_value(value) for value in row])
 
-# Group endpoints by GroupId
-endpoints_by_group = defaultdict(list)
-for endpoint in endpoints:
-    endpoints_by_group[endpoint["GroupId"]].append(endpoint)
 
 # Data to collect
-container_stats_data = []
+container_stats_data = Table(CONTAINER_STATS_COLUMNS)
 nodes_dict = {}
 request_errors = []
-secrets_data = []
-services_data = []
-endpoints_data = []
-
-
-def process_endpoint(endpoint):
+secrets_data = Table(SECRET_COLUMNS)
+services_data = Table(SERVICE_COLUMNS)
+endpoints_data = Table(ENDPOINT_COLUMNS)
+
+
+def summarize_stats(stats):
+    """ Reduce a container stats payload to the values shown by 'docker stats' """
+    cpu_stats = stats.get("cpu_stats", {})
+    cpu_usage = cpu_stats.get("cpu_usage", {})
+    precpu_stats = stats.get("precpu_stats", {})
+    cpu_delta = cpu_usage.get("total_usage", 0) - precpu_stats.get("cpu_usage", {}).get("total_usage", 0)
+    system_delta = cpu_stats.get("system_cpu_usage", 0) - precpu_stats.get("system_cpu_usage", 0)
+    online_cpus = cpu_stats.get("online_cpus") or len(cpu_usage.get("percpu_usage") or ()) or 1
+    cpu_percent = cpu_delta / system_delta * online_cpus * 100 if cpu_delta > 0 and system_delta > 0 else 0.0
+
+    memory_stats = stats.get("memory_stats", {})
+    memory_limit = memory_stats.get("limit")
+    memory_usage = memory_stats.get("usage")
+    if memory_usage is not None:
+        # Inactive page cache is not counted, as in the Docker CLI: total_inactive_file on
+        # cgroup v1, inactive_file on cgroup v2, and only when it is below the usage
+        memory_details = memory_stats.get("stats", {})
+        if memory_details.get("total_inactive_file", memory_usage) < memory_usage:
+            memory_usage -= memory_details["total_inactive_file"]
+        elif memory_details.get("inactive_file", 0) < memory_usage:
+            memory_usage -= memory_details.get("inactive_file", 0)
+    memory_percent = memory_usage / memory_limit * 100 if memory_usage is not None and memory_limit else None
+
+    return (
+        stats.get("name", "").lstrip("/"),
+        round(cpu_percent, 2),
+        memory_usage,
+        memory_limit,
+        round(memory_percent, 2) if memory_percent is not None else None
+    )
+
+
+async def get_containers_with_stats(portainer_api, endpoint_id):
+    """ Get the containers of an endpoint paired with their statistics """
+    # Stopped containers have no statistics worth a round-trip
+    containers = [container for container in await portainer_api.get_containers(endpoint_id) or []
+                  if container.get("State") == "running"]
+    # Request the statistics of all containers concurrently as soon as the list is known
+    all_stats = await asyncio.gather(
+        *[portainer_api.get_container_stats(endpoint_id, container["Id"]) for container in containers]
+    )
+    return list(zip(containers, all_stats))
+
+
+async def process_endpoint(portainer_api, endpoint):
     endpoint_id = endpoint["Id"]
     endpoint_name = endpoint["Name"]
     group_id = endpoint["GroupId"]
     group_name = portainer_api.get_group_name(group_id)
 
-    # Append endpoint data to the endpoints_data list
-    endpoints_data.append({
-        "Endpoint_Id": endpoint_id,
-        "Endpoint_Name": endpoint_name,
-        "Group_Id": group_id,
-        "Group_Name": group_name
-    })
+    # Rows collected for this endpoint; they are merged by main()
+    service_rows = Table(SERVICE_COLUMNS)
+    secret_rows = Table(SECRET_COLUMNS)
+    node_rows = Table(NODE_COLUMNS)
+    stat_rows = Table(CONTAINER_STATS_COLUMNS)
 
-    print(f"Processing Endpoint: {endpoint_name} (ID: {endpoint_id}, Group: {group_name})")
+    log.info("Processing Endpoint: %s (ID: %s, Group: %s)", endpoint_name, endpoint_id, group_name)
 
-    # Use the class methods to retrieve data
-    services = portainer_api.get_services(endpoint_id)
-    secrets = portainer_api.get_secrets(endpoint_id)
-    nodes = portainer_api.get_nodes(endpoint_id)
-    containers = portainer_api.get_containers(endpoint_id)
+    # Use the class methods to retrieve data concurrently
+    services, secrets, nodes, containers_with_stats = await asyncio.gather(
+        portainer_api.get_services(endpoint_id),
+        portainer_api.get_secrets(endpoint_id),
+        portainer_api.get_nodes(endpoint_id),
+        get_containers_with_stats(portainer_api, endpoint_id),
+    )
 
     # Process services
     if services:
         for service in services:
+            spec = service["Spec"]
+            container_spec = spec["TaskTemplate"]["ContainerSpec"]
+
             # Extract environment variable keys
-            env_keys = [env.split('=')[0] for env in service["Spec"]["TaskTemplate"]["ContainerSpec"].get("Env", [])]
+            env_keys = [env.partition('=')[0] for env in container_spec.get("Env", ())]
 
             # Extract only the 'image:tag' part of the full image string
-            full_image = service["Spec"]["TaskTemplate"]["ContainerSpec"]["Image"]
-            image_without_sha = full_image.split('@')[0]
+            full_image = container_spec["Image"]
+            image_without_sha = full_image.partition('@')[0]
 
             # Process configurations of each service
             config_details = []
-            if "Configs" in service["Spec"]["TaskTemplate"]["ContainerSpec"]:
-                for config in service["Spec"]["TaskTemplate"]["ContainerSpec"]["Configs"]:
-                    config_detail = {
-                        "ConfigName": config["ConfigName"],
-                        "FilePath": config["File"]["Name"]
-                    }
-                    config_details.append(config_detail)
+            for config in container_spec.get("Configs", ()):
+                config_detail = {
+                    "ConfigName": config["ConfigName"],
+                    "FilePath": config["File"]["Name"]
+                }
+                config_details.append(config_detail)
 
             # Process mounts of each service
             mounts_details = []
-            if "Mounts" in service["Spec"]["TaskTemplate"]["ContainerSpec"]:
-                for mount in service["Spec"]["TaskTemplate"]["ContainerSpec"]["Mounts"]:
-                    mount_detail = {
-                        "Source": mount["Source"],
-                        "Target": mount["Target"],
-                        "Type": mount["Type"]
-                    }
-                    mounts_details.append(mount_detail)
-
-            mode = service["Spec"]["Mode"]
+            for mount in container_spec.get("Mounts", ()):
+                mount_detail = {
+                    "Source": mount["Source"],
+                    "Target": mount["Target"],
+                    "Type": mount["Type"]
+                }
+                mounts_details.append(mount_detail)
+
+            mode = spec["Mode"]
             if "Replicated" in mode:
                 replicas = mode["Replicated"]["Replicas"]
             else:
                 replicas = 0  # Or None, depending on how you want to handle non-replicated services
 
             # Process the stack
-            labels = service["Spec"]["TaskTemplate"]["ContainerSpec"].get("Labels", {})
+            labels = container_spec.get("Labels", {})
             stack = labels.get("com.docker.stack.namespace")
 
             # Create a simplified service object
-            services_data.append({
-                "Endpoint_Id": endpoint_id,
-                "Endpoint": endpoint_name,
-                "Group": group_name,
-                "Stack": stack,
-                "Name": service["Spec"]["Name"],
-                "Replicas": replicas,
-                "Image": image_without_sha,
-                "Environment_Variables": env_keys,
-                "Configurations": config_details,
-                "Mounts": mounts_details
-            })
+            service_rows.append(
+                endpoint_id,
+                endpoint_name,
+                group_name,
+                stack,
+                spec["Name"],
+                replicas,
+                image_without_sha,
+                env_keys,
+                config_details,
+                mounts_details
+            )
 
     # Process secrets
     if secrets:
@@ -123,74 +217,86 @@ def process_endpoint(endpoint):
         secret_names = [secret["Spec"]["Name"] for secret in secrets]
 
         # Add the list of secret names as a single item
-        secrets_data.append({
-            "Endpoint": endpoint_name,
-            "Type": "Secret",
-            "Names": secret_names
-        })
+        secret_rows.append(endpoint_name, "Secret", secret_names)
 
     # Process nodes
     if nodes:
         for node in nodes:
-            hostname = node["Description"]["Hostname"]
-            # Check if this node has been processed already
-            if hostname not in nodes_dict:
-                nodes_dict[hostname] = {
-                    "Endpoint": endpoint_name,
-                    "Hostname": node["Description"]["Hostname"],
-                    "Role": node["Spec"]["Role"],
-                    "Availability": node["Spec"]["Availability"],
-                    "NanoCPUs": node["Description"]["Resources"]["NanoCPUs"],
-                    "MemoryBytes": node["Description"]["Resources"]["MemoryBytes"],
-                    "State": node["Status"]["State"]
-                }
-
-    if containers:
-        for container in containers:
-            container_id = container["Id"]
-            container_stack = container["Labels"].get("com.docker.stack.namespace", "Unknown")
-            container_service = container["Labels"].get("com.docker.swarm.service.name", "Unknown")
-
-            # Get container statistics
-            stats = portainer_api.get_container_stats(endpoint_id, container_id)
-            if stats:
-                container_stats_data.append({
-                    "Endpoint": endpoint_name,
-                    "Stack": container_stack,
-                    "Service": container_service,
-                    "stats": stats,
-                })
-
-
-def process_group(group_endpoints):
-    for endpoint in group_endpoints:
-        process_endpoint(endpoint)
-
-
-with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-    futures = [executor.submit(process_group, group) for group in endpoints_by_group.values()]
-
-request_errors = portainer_api.get_request_errors()
+            node_rows.append(
+                endpoint_name,
+                node["Description"]["Hostname"],
+                node["Spec"]["Role"],
+                node["Spec"]["Availability"],
+                node["Description"]["Resources"]["NanoCPUs"],
+                node["Description"]["Resources"]["MemoryBytes"],
+                node["Status"]["State"]
+            )
+
+    for container, stats in containers_with_stats:
+        container_stack = container["Labels"].get("com.docker.stack.namespace", "Unknown")
+        container_service = container["Labels"].get("com.docker.swarm.service.name", "Unknown")
+
+        if stats:
+            stat_rows.append(endpoint_name, container_stack, container_service, *summarize_stats(stats))
+
+    return service_rows, secret_rows, node_rows, stat_rows
+
+
+async def main():
+    # Share a single PortainerAPI session (and connection pool) for the whole run
+    async with PortainerAPI(url_portainer, username, password, max_connections) as portainer_api:
+        # Get all the endpoints available in Portainer
+        endpoints = await portainer_api.get_endpoints() or []
+
+        # One task per endpoint; a failing endpoint must not abort the others
+        results = await asyncio.gather(
+            *[process_endpoint(portainer_api, endpoint) for endpoint in endpoints],
+            return_exceptions=True
+        )
+        for endpoint, result in zip(endpoints, results):
+            # Every endpoint is listed, including those whose processing failed
+            endpoints_data.append(endpoint["Id"], endpoint["Name"], endpoint["GroupId"],
+                                  portainer_api.get_group_name(endpoint["GroupId"]))
+
+            if isinstance(result, Exception):
+                log.error("Processing failed for Endpoint: %s (%r)", endpoint["Name"], result)
+                portainer_api.record_error(f"{portainer_api.base_url}/api/endpoints/{endpoint['Id']}", result)
+                continue
+
+            # Merge the rows of each endpoint in a single place
+            service_rows, secret_rows, node_rows, stat_rows = result
+            services_data.extend(service_rows)
+            secrets_data.extend(secret_rows)
+            container_stats_data.extend(stat_rows)
+            for hostname, node_row in zip(node_rows.data["Hostname"], node_rows.rows()):
+                # The same node is reported by every endpoint of its swarm; keep the first one
+                nodes_dict.setdefault(hostname, node_row)
+
+        return portainer_api.get_request_errors()
+
+
+request_errors = asyncio.run(main())
 
 # Convert the collected data into DataFrames
-df_services = pd.DataFrame(services_data)
-df_secrets = pd.DataFrame(secrets_data)
-df_nodes = pd.DataFrame(nodes_dict.values())
-df_container_stats = pd.DataFrame(container_stats_data)
+df_services = services_data.to_dataframe()
+df_secrets = secrets_data.to_dataframe()
+df_nodes = pd.DataFrame(list(nodes_dict.values()), columns=list(NODE_COLUMNS))
+df_container_stats = container_stats_data.to_dataframe()
 df_request_errors = pd.DataFrame(request_errors)
-df_endpoints = pd.DataFrame(endpoints_data)
+df_endpoints = endpoints_data.to_dataframe()
 
 
 # Construct the filename with the domain slug
 filename = f"portainer_data_{domain_slug}.xlsx"
 
-# Export DataFrames to an Excel file
-with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-    df_services.to_excel(writer, sheet_name="Services", index=False)
-    df_secrets.to_excel(writer, sheet_name="Secrets", index=False)
-    df_nodes.to_excel(writer, sheet_name="Nodes", index=False)
-    df_container_stats.to_excel(writer, sheet_name="Container Statistics", index=False)
-    df_request_errors.to_excel(writer, sheet_name="Request Errors", index=False)
-    df_endpoints.to_excel(writer, sheet_name="Endpoints", index=False)
-
-print(f"Data and request errors exported to '{filename}'")
+# Export DataFrames to an Excel file; rows are written in order, so constant_memory can flush them as they go
+with xlsxwriter.Workbook(filename, {'constant_memory': True}) as workbook:
+    bold = workbook.add_format({'bold': True})
+    write_sheet(workbook, "Services", df_services, bold)
+    write_sheet(workbook, "Secrets", df_secrets, bold)
+    write_sheet(workbook, "Nodes", df_nodes, bold)
+    write_sheet(workbook, "Container Statistics", df_container_stats, bold)
+    write_sheet(workbook, "Request Errors", df_request_errors, bold)
+    write_sheet(workbook, "Endpoints", df_endpoints, bold)
+
+log.info("Data and request errors exported to '%s'", filename)
@@ -1,88 +1,215 @@
-import requests
+from urllib.parse import urlparse
+import asyncio
+import contextlib
+import logging
+import os
+import re
+import tempfile
+
+import aiohttp
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional, fall back to the standard library
+    from json import loads as json_loads
+
+log = logging.getLogger(__name__)
+
+# Per-socket timeouts, as a total would also count the wait for a pooled connection;
+# fail fast on connect stalls, allow slower reads (e.g. container stats)
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=3, sock_read=10)
+# GET requests are retried on these statuses and on connection errors/timeouts
+RETRY_STATUSES = frozenset((502, 503, 504))
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.3
+CACHE_DIR = os.path.expanduser("~/.cache/portainer_info_extract")
+
+
+def atomic_write(path, data):
+    """ Write bytes through a private temporary file so readers never see a partial file """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+        raise
+
+
+def is_retryable(error):
+    """ Whether a failed GET request is worth retrying """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
 
 
 class PortainerAPI:
-    def __init__(self, url, username, password):
+    def __init__(self, url, username, password, max_connections=128, cache_dir=CACHE_DIR):
         if not url.startswith(('http://', 'https://')):
             url = 'https://' + url
         self.base_url = url
         self.username = username
         self.password = password
-        self.jwt = self.authenticate()
+        self.max_connections = max_connections
+        self.cache_dir = cache_dir
+        self.session = None
+        self.jwt = None
         self.request_errors = []
+        self._group_map = {}
+
+    async def __aenter__(self):
+        """ Open the shared HTTP session and authenticate """
+        connector = aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300, keepalive_timeout=30)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT)
+        try:
+            self.jwt = await self.authenticate()
+            self.session.headers.update({"Authorization": f"Bearer {self.jwt}"})
+            # Endpoint groups are fetched once and reused for every endpoint
+            self._group_map = {group["Id"]: group["Name"] for group in await self.get_endpoint_groups() or []}
+        except BaseException:
+            await self.close()
+            raise
+        return self
 
-    def authenticate(self):
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """ Close the shared HTTP session """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def authenticate(self):
         """ Authenticate and return JWT token """
         login_url = f"{self.base_url}/api/auth"
         credentials = {"Username": self.username, "Password": self.password}
-        response = requests.post(login_url, json=credentials)
-        response.raise_for_status()
-        return response.json()['jwt']
+        async with self.session.post(login_url, json=credentials) as response:
+            response.raise_for_status()
+            return json_loads(await response.read())['jwt']
+
+    async def safe_request(self, url, cache_key=None):
+        """ Perform a safe HTTP GET request, retrying transient failures, and log errors
+
+        With a cache_key the response is kept on disk and revalidated with its ETag (If-None-Match).
+        """
+        headers = {}
+        etag, cached_data = self.read_cache(cache_key) if cache_key else (None, None)
+        if etag:
+            headers["If-None-Match"] = etag
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                async with self.session.get(url, headers=headers) as response:
+                    if response.status == 304 and cached_data is not None:
+                        return cached_data
+                    response.raise_for_status()
+                    body = await response.read()
+                    if cache_key and "ETag" in response.headers:
+                        self.write_cache(cache_key, response.headers["ETag"], body)
+                    return json_loads(body)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                if attempt < MAX_RETRIES and is_retryable(e):
+                    await asyncio.sleep(BACKOFF_FACTOR * 2 ** attempt)
+                    continue
+                self.record_error(url, e)
+                log.warning("Request failed: %s", str(e) or type(e).__name__)
+                return None
 
-    def get_headers(self):
-        """ Returns the authorization headers """
-        return {"Authorization": f"Bearer {self.jwt}"}
+    def cache_path(self, cache_key):
+        """ Path prefix of the cache files for a key, scoped to this host and user """
+        name = f"{urlparse(self.base_url).netloc}_{self.username}_{cache_key}"
+        return os.path.join(self.cache_dir, re.sub(r'[^\w.-]', '_', name))
 
-    def safe_request(self, url):
-        """ Perform a safe HTTP GET request and log errors """
+    def read_cache(self, cache_key):
+        """ Return the cached (ETag, parsed body) for a key, or (None, None) if missing or unreadable """
+        path = self.cache_path(cache_key)
         try:
-            response = requests.get(url, headers=self.get_headers(), timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            error_details = {
-                "URL": url,
-                "Error": str(e)
-            }
-            self.request_errors.append(error_details)
-            print(f"Request failed: {e}")
-            return None
+            with open(f"{path}.etag", encoding="utf-8") as etag_file, open(f"{path}.json", "rb") as body_file:
+                return etag_file.read(), json_loads(body_file.read())
+        except OSError:
+            return None, None
+        except ValueError:
+            # A corrupt body must not be revalidated forever; drop it so a full GET refreshes it
+            log.warning("Discarding unreadable cache %s", path)
+            self.drop_cache(cache_key)
+            return None, None
+
+    def write_cache(self, cache_key, etag, body):
+        """ Store a response body and its ETag; the cache is best effort """
+        path = self.cache_path(cache_key)
+        try:
+            # The endpoint list includes secrets such as Edge keys; keep the cache private to the user
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            os.chmod(self.cache_dir, 0o700)
+            # Remove the old ETag first, so an interrupted update is never revalidated against
+            self.drop_cache(cache_key)
+            atomic_write(f"{path}.json", body)
+            atomic_write(f"{path}.etag", etag.encode("utf-8"))
+        except OSError as e:
+            log.warning("Could not write cache %s: %s", path, e)
+
+    def drop_cache(self, cache_key):
+        """ Remove the cache files of a key """
+        path = self.cache_path(cache_key)
+        for suffix in (".etag", ".json"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(f"{path}{suffix}")
+
+    def record_error(self, url, error):
+        """ Register an error so it is included in the report """
+        if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError)):
+            message = str(error) or type(error).__name__
+        else:
+            # e.g. str(KeyError('TaskTemplate')) alone would only say 'TaskTemplate'
+            message = f"{type(error).__name__}: {error}"
+        self.request_errors.append({
+            "URL": url,
+            "Error": message
+        })
 
     def get_request_errors(self):
         """ Devuelve los errores registrados durante las solicitudes HTTP """
         return self.request_errors
 
-    def get_endpoints(self):
+    async def get_endpoints(self):
         """ Get all endpoints """
         url = f"{self.base_url}/api/endpoints"
-        return self.safe_request(url)
+        return await self.safe_request(url, cache_key="endpoints")
 
-    def get_endpoint_groups(self):
+    async def get_endpoint_groups(self):
         """ Get all endpoint groups """
         url = f"{self.base_url}/api/endpoint_groups"
-        return self.safe_request(url)
+        return await self.safe_request(url, cache_key="endpoint_groups")
 
-    def get_services(self, endpoint_id):
+    async def get_services(self, endpoint_id):
         """ Get services for a specific endpoint """
-        return self.get_endpoint_data(endpoint_id, "services")
+        return await self.get_endpoint_data(endpoint_id, "services")
 
-    def get_secrets(self, endpoint_id):
+    async def get_secrets(self, endpoint_id):
         """ Get secrets for a specific endpoint """
-        return self.get_endpoint_data(endpoint_id, "secrets")
+        return await self.get_endpoint_data(endpoint_id, "secrets")
 
-    def get_nodes(self, endpoint_id):
+    async def get_nodes(self, endpoint_id):
         """ Get nodes for a specific endpoint """
-        return self.get_endpoint_data(endpoint_id, "nodes")
+        return await self.get_endpoint_data(endpoint_id, "nodes")
 
-    def get_containers(self, endpoint_id):
+    async def get_containers(self, endpoint_id):
         """ Get a list of containers for a specific endpoint """
         url = f"{self.base_url}/api/endpoints/{endpoint_id}/docker/containers/json"
-        return self.safe_request(url)
+        return await self.safe_request(url)
 
-    def get_container_stats(self, endpoint_id, container_id):
+    async def get_container_stats(self, endpoint_id, container_id):
         """ Get container statistics for a specific container """
         url = f"{self.base_url}/api/endpoints/{endpoint_id}/docker/containers/{container_id}/stats?stream=false"
-        return self.safe_request(url)
+        return await self.safe_request(url)
 
-    def get_endpoint_data(self, endpoint_id, data_type):
+    async def get_endpoint_data(self, endpoint_id, data_type):
         """ Get data (services, secrets, etc.) for a specific endpoint """
         url = f"{self.base_url}/api/endpoints/{endpoint_id}/docker/{data_type}"
-        return self.safe_request(url)
+        return await self.safe_request(url)
 
     def get_group_name(self, group_id):
         """ Get the name of a group by its ID """
-        groups = self.get_endpoint_groups()
-        for group in groups:
-            if group["Id"] == group_id:
-                return group["Name"]
-        return "Unknown Group"
+        return self._group_map.get(group_id, "Unknown Group")